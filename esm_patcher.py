@@ -12,10 +12,15 @@ This tool applies xdelta3 patches to convert Fallout4.esm files between:
 
 import os
 import sys
-import shutil
+import stat
 import subprocess
 import tempfile
-import hashlib
+import threading
+import bisect
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from pathlib import Path
@@ -34,6 +39,178 @@ logging.basicConfig(
     ]
 )
 
+# File extension accepted for a direct ESM path on the command line
+ESM_SUFFIX = ".esm"
+
+# Versions accepted by the CLI --target flag
+VALID_TARGETS = frozenset({"1.10.163", "nextgen"})
+
+# Buffer size for userspace file copies (1 MiB)
+COPY_BUFFER_SIZE = 1 << 20
+
+@dataclass(frozen=True)
+class VersionRecord:
+    """Metadata for a known Fallout4.esm file size"""
+    version: str
+    display: str
+    patches_to: MappingProxyType
+    is_patched: bool = False
+    
+    def to_version_info(self, file_size: int) -> dict:
+        """Build the detect_esm_version result for a file of this version"""
+        return {
+            "exists": True,
+            "size": file_size,
+            "version": self.version,
+            "display": self.display,
+            "available_targets": tuple(self.patches_to.keys()),
+            "patches": self.patches_to
+        }
+
+
+def advise_sequential(fd: int):
+    """Hint the kernel that a file will be read front to back (no-op where unsupported)"""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+def preallocate(fd: int, size: int):
+    """
+    Reserve space for a file before writing it, so it's allocated in one go.
+    
+    Uses posix_fallocate where available, otherwise just sets the file size.
+    """
+    if size <= 0:
+        return
+    
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            # Not supported by this filesystem
+            pass
+    
+    try:
+        os.ftruncate(fd, size)
+    except OSError:
+        pass
+
+
+def safe_unlink(path: str):
+    """Remove a file, ignoring it if it doesn't exist"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# CopyFileExW prototype, set up once at import (Windows only)
+if os.name == "nt":
+    import ctypes
+    from ctypes import wintypes
+    
+    _kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    _CopyFileExW = _kernel32.CopyFileExW
+    _CopyFileExW.argtypes = [
+        wintypes.LPCWSTR, wintypes.LPCWSTR, ctypes.c_void_p,
+        ctypes.c_void_p, ctypes.c_void_p, wintypes.DWORD
+    ]
+    _CopyFileExW.restype = wintypes.BOOL
+
+
+def copy_file_windows(src: str, dst: str):
+    """Copy a file with the Win32 CopyFileExW API (raises OSError on failure)"""
+    if not _CopyFileExW(src, dst, None, None, None, 0):
+        raise ctypes.WinError(ctypes.get_last_error())
+
+
+def copy_file(src: str, dst: str):
+    """
+    Copy file contents from src to dst.
+    
+    Uses the kernel copy API where available so data doesn't go through
+    userspace: CopyFileExW on Windows, os.copy_file_range on Linux (which can
+    reflink on CoW filesystems). Falls back to a buffered copy.
+    """
+    if os.name == "nt":
+        try:
+            copy_file_windows(src, dst)
+            return
+        except OSError:
+            pass
+    
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        # Copied nothing before the end; redo it with a regular copy
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                return
+        except OSError:
+            # Not supported for this filesystem pair (e.g. EXDEV), use regular copy
+            pass
+    
+    copy_file_buffered(src, dst)
+
+
+def copy_file_buffered(src: str, dst: str):
+    """Copy a file through a preallocated COPY_BUFFER_SIZE buffer"""
+    buf = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "wb") as fdst:
+        advise_sequential(fsrc.fileno())
+        preallocate(fdst.fileno(), os.fstat(fsrc.fileno()).st_size)
+        while True:
+            size = fsrc.readinto(buf)
+            if not size:
+                break
+            fdst.write(view[:size])
+        
+        # Trim in case the source shrank after the size was taken
+        fdst.truncate()
+
+
+def find_esm_in_folder(folder_path: str) -> Optional[str]:
+    """
+    Find Fallout4.esm in a game folder or its Data subfolder.
+    
+    Names are matched case-insensitively from directory listings, so each
+    folder costs one enumeration instead of a stat per candidate path.
+    """
+    data_dir = None
+    
+    try:
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                name = entry.name.lower()
+                if name == "fallout4.esm" and entry.is_file():
+                    return entry.path
+                if name == "data" and entry.is_dir():
+                    data_dir = entry.path
+    except OSError:
+        return None
+    
+    if data_dir:
+        try:
+            with os.scandir(data_dir) as entries:
+                for entry in entries:
+                    if entry.name.lower() == "fallout4.esm" and entry.is_file():
+                        return entry.path
+        except OSError:
+            pass
+    
+    return None
+
+
 class ESMPatcher:
     """Main patcher class for Fallout4.esm files"""
     
@@ -71,25 +248,40 @@ class ESMPatcher:
         },
     }
     
-    # Legacy compatibility mappings (deprecated, use ESM_VERSIONS instead)
-    PATCH_MAPPINGS = {
-        330777465: {
-            "patch": "fallout4_323025.xdelta",
-            "description": "Next-Gen",
-            "md5": "a5c13fb8c0e2e9c7c0c8e6f9d4b5a3e2"
+    # Sizes of already-patched files, matched within PATCHED_SIZE_TOLERANCE bytes
+    PATCHED_SIZE_TOLERANCE = 1000
+    PATCHED_SIZES = [
+        (61741779, "VR-compatible version (58.9 MB)"),
+        (61598851, "VR-compatible version (58.7 MB)"),
+    ]
+    PATCHED_SIZES_SORTED = sorted(size for size, _ in PATCHED_SIZES)
+    
+    # Single size -> VersionRecord index covering every known size
+    SIZE_INDEX = {
+        **{
+            size: VersionRecord(info["version"], info["display"], MappingProxyType(info["patches_to"]))
+            for size, info in ESM_VERSIONS.items()
+        },
+        **{
+            size: VersionRecord("patched", description, MappingProxyType({}), is_patched=True)
+            for size, description in PATCHED_SIZES
         },
-        330553163: {
-            "patch": "fallout4_322806.xdelta",
-            "description": "Fallout 4 VR",
-            "md5": "b7d24fa9e1d3c8b6a4f5e7c9d2a1b3c4"
-        }
     }
     
-    # Known sizes that are already patched or incompatible (no patching available)
-    COMPATIBLE_SIZES = {
-        61741779: "Patched/compatible version (58.9 MB)",
-        61598851: "Patched/compatible version (58.7 MB)",
-    }
+    # detect_esm_version results for exact known sizes, built once at import
+    KNOWN_VERSION_INFO = {size: record.to_version_info(size) for size, record in SIZE_INDEX.items()}
+    
+    # Every patch file referenced by SIZE_INDEX, plus the xdelta3 binary
+    PATCH_FILES = frozenset(
+        patch for record in SIZE_INDEX.values() for patch in record.patches_to.values()
+    )
+    REQUIRED_ASSETS = PATCH_FILES | {"xdelta3.exe"}
+    
+    # Record type every Fallout 4 plugin file starts with
+    PLUGIN_HEADER = b"TES4"
+    
+    # How long cached stat results stay valid (seconds)
+    STAT_CACHE_TTL = 1.0
     
     def __init__(self):
         """Initialize the patcher"""
@@ -97,6 +289,13 @@ class ESMPatcher:
         self.xdelta_path = os.path.join(self.assets_dir, "xdelta3.exe")
         self.current_esm_path = None
         self.backup_created = False
+        self._stat_cache = {}
+        self._version_cache = {}
+        self.rescan_assets()
+        
+        # Resolve every patch path once up front; the assets layout is fixed at startup
+        assets = Path(self.assets_dir).resolve()
+        self._patch_paths = {name: str(assets / name) for name in self.PATCH_FILES}
         
     def get_assets_directory(self) -> str:
         """Get the assets directory path"""
@@ -107,70 +306,100 @@ class ESMPatcher:
             # Running as script
             return os.path.join(os.path.dirname(__file__), "assets")
     
+    def rescan_assets(self):
+        """Cache the names of files in the assets directory (assets don't change at runtime)"""
+        try:
+            with os.scandir(self.assets_dir) as entries:
+                self._asset_set = {entry.name for entry in entries}
+        except OSError:
+            self._asset_set = set()
+    
     def verify_dependencies(self) -> Tuple[bool, str]:
         """Verify all required files are present"""
-        missing_files = []
-        
-        # Check xdelta3.exe
-        if not os.path.exists(self.xdelta_path):
-            missing_files.append("xdelta3.exe")
-        
-        # Check patch files
-        for patch_info in self.PATCH_MAPPINGS.values():
-            patch_path = os.path.join(self.assets_dir, patch_info["patch"])
-            if not os.path.exists(patch_path):
-                missing_files.append(patch_info["patch"])
+        missing_files = sorted(self.REQUIRED_ASSETS - self._asset_set)
         
         if missing_files:
             return False, f"Missing required files: {', '.join(missing_files)}"
         
         return True, "All dependencies verified"
     
+    def cached_stat(self, path: str) -> Optional[os.stat_result]:
+        """
+        Stat a path, reusing results younger than STAT_CACHE_TTL seconds.
+        
+        Returns None if the path doesn't exist.
+        """
+        now = time.monotonic()
+        cached = self._stat_cache.get(path)
+        if cached and now - cached[0] < self.STAT_CACHE_TTL:
+            return cached[1]
+        
+        try:
+            result = os.stat(path)
+        except OSError:
+            result = None
+        
+        self._stat_cache[path] = (now, result)
+        return result
+    
+    def invalidate_stat(self, esm_path: str):
+        """Drop cached stats for an ESM and its backup after they are modified"""
+        self._stat_cache.pop(esm_path, None)
+        self._stat_cache.pop(esm_path + ".backup", None)
+    
     def get_file_info(self, file_path: str) -> dict:
-        """Get detailed information about a file"""
-        if not os.path.exists(file_path):
-            return {"exists": False}
+        """
+        Get detailed information about a file.
         
-        file_size = os.path.getsize(file_path)
+        Only stats the file; version detection needs nothing beyond the size.
+        """
+        file_stat = self.cached_stat(file_path)
+        if file_stat is None:
+            return {"exists": False}
         
-        # Calculate MD5 hash
-        md5_hash = hashlib.md5()
-        with open(file_path, "rb") as f:
-            # Read in chunks to handle large files
-            for chunk in iter(lambda: f.read(4096), b""):
-                md5_hash.update(chunk)
+        file_size = file_stat.st_size
         
         return {
             "exists": True,
             "size": file_size,
             "size_mb": file_size / (1024 * 1024),
-            "md5": md5_hash.hexdigest(),
             "path": file_path
         }
     
+    @classmethod
+    def lookup_size(cls, file_size: int) -> Optional["VersionRecord"]:
+        """Look up the record for a file size, allowing tolerance for patched sizes"""
+        record = cls.SIZE_INDEX.get(file_size)
+        if record:
+            return record
+        
+        # Only the nearest patched size on either side can be within tolerance
+        sizes = cls.PATCHED_SIZES_SORTED
+        index = bisect.bisect_left(sizes, file_size)
+        for candidate in sizes[max(index - 1, 0):index + 1]:
+            if abs(file_size - candidate) < cls.PATCHED_SIZE_TOLERANCE:
+                return cls.SIZE_INDEX[candidate]
+        
+        return None
+    
     def identify_esm_version(self, esm_path: str) -> Tuple[bool, str, Optional[dict]]:
         """Identify if ESM needs patching and which patch to use (legacy method)"""
-        file_info = self.get_file_info(esm_path)
-        
-        if not file_info["exists"]:
+        file_stat = self.cached_stat(esm_path)
+        if file_stat is None:
             return False, "File does not exist", None
         
-        file_size = file_info["size"]
-        
-        # Check if this is a known patchable size
-        if file_size in self.PATCH_MAPPINGS:
-            patch_info = self.PATCH_MAPPINGS[file_size]
-            return True, f"Next-Gen ESM detected ({patch_info['description']})", patch_info
+        file_size = file_stat.st_size
+        record = self.lookup_size(file_size)
         
         # Check if it's already patched (different known sizes)
-        known_patched_sizes = [
-            (61741779, "VR-compatible version (58.9 MB)"),
-            (61598851, "VR-compatible version (58.7 MB)"),
-        ]
+        if record and record.is_patched:
+            return False, f"Already patched: {record.display}", None
         
-        for size, description in known_patched_sizes:
-            if abs(file_size - size) < 1000:  # Within 1KB tolerance
-                return False, f"Already patched: {description}", None
+        # Check if this is a known size that can be patched to 1.10.163
+        patch = record.patches_to.get(self.VERSION_OLD) if record else None
+        if patch:
+            patch_info = {"patch": patch, "description": record.display}
+            return True, f"Next-Gen ESM detected ({record.display})", patch_info
         
         # Unknown size
         return False, f"Unknown ESM version (size: {file_size:,} bytes)", None
@@ -184,50 +413,59 @@ class ESMPatcher:
             - size: int (file size in bytes)
             - version: str or None ("nextgen", "1.10.163", or None if unknown)
             - display: str (human-readable version description)
-            - available_targets: list of target versions this can be patched to
-            - patches: dict mapping target version to patch filename
-        """
-        file_info = self.get_file_info(esm_path)
+            - available_targets: tuple of target versions this can be patched to
+            - patches: read-only mapping of target version to patch filename
         
-        if not file_info["exists"]:
+        Known versions are identified from the file size alone; the file is only
+        read (a few header bytes) when the size is unknown.
+        """
+        file_stat = self.cached_stat(esm_path)
+        if file_stat is None:
             return {
                 "exists": False,
                 "version": None,
                 "display": "File does not exist",
-                "available_targets": [],
-                "patches": {}
+                "available_targets": (),
+                "patches": MappingProxyType({})
             }
         
-        file_size = file_info["size"]
+        cache_key = (esm_path, file_stat.st_mtime_ns, file_stat.st_size)
+        version_info = self._version_cache.get(cache_key)
+        if version_info is not None:
+            # Copy so callers can't alter the cached result
+            return dict(version_info)
         
-        # Check known versions
-        if file_size in self.ESM_VERSIONS:
-            version_info = self.ESM_VERSIONS[file_size]
-            return {
-                "exists": True,
-                "size": file_size,
-                "version": version_info["version"],
-                "display": version_info["display"],
-                "available_targets": list(version_info["patches_to"].keys()),
-                "patches": version_info["patches_to"]
-            }
+        version_info = self._detect(file_stat.st_size)
         
-        # Check if it's an already-patched small version
-        known_patched_sizes = [
-            (61741779, "VR-compatible version (58.9 MB)"),
-            (61598851, "VR-compatible version (58.7 MB)"),
-        ]
+        # Unknown size: check the record header to tell a modified ESM from a non-plugin file
+        if version_info["version"] is None and not self.has_plugin_header(esm_path):
+            version_info = {
+                **version_info,
+                "display": f"Not a valid ESM file ({file_stat.st_size:,} bytes)"
+            }
         
-        for size, description in known_patched_sizes:
-            if abs(file_size - size) < 1000:
-                return {
-                    "exists": True,
-                    "size": file_size,
-                    "version": "patched",
-                    "display": description,
-                    "available_targets": [],
-                    "patches": {}
-                }
+        self._version_cache[cache_key] = version_info
+        return dict(version_info)
+    
+    def has_plugin_header(self, file_path: str) -> bool:
+        """Check whether a file starts with the TES4 plugin header record"""
+        try:
+            with open(file_path, "rb") as f:
+                return f.read(len(self.PLUGIN_HEADER)) == self.PLUGIN_HEADER
+        except OSError:
+            return False
+    
+    @classmethod
+    def _detect(cls, file_size: int) -> dict:
+        """Map a file size to its version info (pure function of size)"""
+        # Exact matches are prebuilt at import
+        version_info = cls.KNOWN_VERSION_INFO.get(file_size)
+        if version_info:
+            return version_info
+        
+        record = cls.lookup_size(file_size)
+        if record:
+            return record.to_version_info(file_size)
         
         # Unknown version
         return {
@@ -235,17 +473,22 @@ class ESMPatcher:
             "size": file_size,
             "version": None,
             "display": f"Unknown version ({file_size:,} bytes / {file_size/(1024*1024):.2f} MB)",
-            "available_targets": [],
-            "patches": {}
+            "available_targets": (),
+            "patches": MappingProxyType({})
         }
     
-    def get_patch_for_target(self, esm_path: str, target_version: str) -> Optional[dict]:
+    def get_patch_for_target(self, esm_path: str, target_version: str,
+                             version_info: Optional[dict] = None) -> Optional[dict]:
         """
         Get patch info for converting to a specific target version.
         
+        Pass version_info if detect_esm_version has already been called for
+        esm_path to avoid detecting it again.
+        
         Returns dict with 'patch' key containing filename, or None if not available.
         """
-        version_info = self.detect_esm_version(esm_path)
+        if version_info is None:
+            version_info = self.detect_esm_version(esm_path)
         
         if target_version in version_info["patches"]:
             return {
@@ -257,35 +500,76 @@ class ESMPatcher:
         
         return None
     
-    def create_backup(self, esm_path: str) -> Tuple[bool, str]:
-        """Create a backup of the ESM file"""
+    @classmethod
+    def get_version_size(cls, version: Optional[str]) -> Optional[int]:
+        """Get the expected file size of a known version, or None"""
+        for size, record in cls.SIZE_INDEX.items():
+            if not record.is_patched and record.version == version:
+                return size
+        return None
+    
+    def get_patched_output_path(self, esm_path: str) -> str:
+        """Get the temporary path xdelta3 writes the patched file to"""
+        return esm_path + ".patched"
+    
+    def confirm_backup_overwrite(self, esm_path: str) -> bool:
+        """Ask before replacing an existing backup (True if there is none)"""
+        backup_path = esm_path + ".backup"
+        if not os.path.exists(backup_path):
+            return True
+        
+        return messagebox.askyesno(
+            "Backup Exists",
+            f"A backup already exists at:\n{backup_path}\n\nOverwrite it?"
+        )
+    
+    def create_backup(self, esm_path: str, confirm_overwrite: bool = True) -> Tuple[bool, str]:
+        """
+        Create a backup of the ESM file.
+        
+        Pass confirm_overwrite=False when the caller has already asked with
+        confirm_backup_overwrite(), e.g. before running the copy off the Tk thread.
+        """
         try:
             backup_path = esm_path + ".backup"
             
             # Check if backup already exists
-            if os.path.exists(backup_path):
-                response = messagebox.askyesno(
-                    "Backup Exists",
-                    f"A backup already exists at:\n{backup_path}\n\nOverwrite it?"
-                )
-                if not response:
-                    return False, "Backup cancelled by user"
+            if confirm_overwrite and not self.confirm_backup_overwrite(esm_path):
+                return False, "Backup cancelled by user"
+            
+            logging.info("Creating backup: %s", backup_path)
+            safe_unlink(backup_path)
             
-            logging.info(f"Creating backup: {backup_path}")
-            shutil.copy2(esm_path, backup_path)
+            # A hard link costs no disk space and stays pristine, since patching
+            # swaps a new file into place instead of modifying the original
+            try:
+                os.link(esm_path, backup_path)
+                logging.info("Backup created as hard link")
+            except OSError:
+                copy_file(esm_path, backup_path)
             self.backup_created = True
             
             return True, backup_path
             
         except Exception as e:
-            logging.error(f"Failed to create backup: {e}")
+            logging.error("Failed to create backup: %s", e)
             return False, str(e)
+        
+        finally:
+            self.invalidate_stat(esm_path)
     
     def apply_patch(self, esm_path: str, patch_info: dict, progress_callback=None) -> Tuple[bool, str]:
-        """Apply the xdelta3 patch to the ESM file"""
+        """
+        Apply the xdelta3 patch to the ESM file.
+        
+        xdelta3 reads the source ESM and writes the patched output directly on
+        disk; the file contents never pass through Python memory.
+        """
         try:
-            patch_path = os.path.join(self.assets_dir, patch_info["patch"])
-            temp_output = esm_path + ".patched"
+            patch_path = self._patch_paths.get(patch_info["patch"])
+            if patch_path is None:
+                patch_path = os.path.join(self.assets_dir, patch_info["patch"])
+            temp_output = self.get_patched_output_path(esm_path)
             
             # Build xdelta3 command
             cmd = [
@@ -297,7 +581,7 @@ class ESMPatcher:
                 temp_output  # Output file
             ]
             
-            logging.info(f"Running command: {' '.join(cmd)}")
+            logging.info("Running command: %s", " ".join(cmd))
             
             if progress_callback:
                 progress_callback(30, "Applying patch...")
@@ -305,15 +589,15 @@ class ESMPatcher:
             # Run xdelta3
             result = subprocess.run(
                 cmd,
-                capture_output=True,
-                text=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
                 timeout=120
             )
             
             if result.returncode != 0:
                 error_msg = f"xdelta3 failed with return code {result.returncode}"
                 if result.stderr:
-                    error_msg += f"\nError: {result.stderr}"
+                    error_msg += f"\nError: {result.stderr.decode('utf-8', errors='replace')}"
                 logging.error(error_msg)
                 return False, error_msg
             
@@ -321,52 +605,106 @@ class ESMPatcher:
                 progress_callback(70, "Verifying patched file...")
             
             # Verify the patched file exists and has reasonable size
-            if not os.path.exists(temp_output):
+            try:
+                patched_size = os.stat(temp_output).st_size
+            except FileNotFoundError:
                 return False, "Patched file was not created"
             
-            patched_size = os.path.getsize(temp_output)
             if patched_size < 50000000:  # Less than 50MB is definitely wrong
-                os.remove(temp_output)
+                safe_unlink(temp_output)
                 return False, f"Patched file is too small ({patched_size} bytes)"
             
             if progress_callback:
                 progress_callback(90, "Replacing original file...")
             
-            # Replace original with patched version
-            os.remove(esm_path)
-            os.rename(temp_output, esm_path)
+            # Replace original with patched version (atomic, no window without an ESM)
+            os.replace(temp_output, esm_path)
             
-            logging.info(f"Patch applied successfully. New size: {patched_size:,} bytes")
+            logging.info("Patch applied successfully. New size: %d bytes", patched_size)
             
             return True, f"Patch applied successfully!\nNew file size: {patched_size:,} bytes ({patched_size/(1024*1024):.2f} MB)"
             
         except subprocess.TimeoutExpired:
-            if os.path.exists(temp_output):
-                os.remove(temp_output)
+            safe_unlink(temp_output)
             return False, "Patching process timed out"
             
         except Exception as e:
-            if os.path.exists(temp_output):
-                os.remove(temp_output)
-            logging.error(f"Error applying patch: {e}")
+            safe_unlink(temp_output)
+            logging.error("Error applying patch: %s", e)
             return False, str(e)
+        
+        finally:
+            self.invalidate_stat(esm_path)
     
     def restore_backup(self, esm_path: str) -> Tuple[bool, str]:
         """Restore the ESM file from backup"""
         backup_path = esm_path + ".backup"
+        temp_output = esm_path + ".tmp"
         
         if not os.path.exists(backup_path):
             return False, "No backup file found"
         
         try:
-            if os.path.exists(esm_path):
-                os.remove(esm_path)
-            shutil.copy2(backup_path, esm_path)
-            logging.info(f"Restored from backup: {backup_path}")
+            # A hard-linked backup of an unpatched file is the same file; nothing to copy
+            if os.path.exists(esm_path) and os.path.samefile(esm_path, backup_path):
+                logging.info("File already matches backup: %s", backup_path)
+                return True, "File already matches the backup"
+            
+            # Copy to a temp file first, then atomically swap it into place
+            copy_file(backup_path, temp_output)
+            os.replace(temp_output, esm_path)
+            logging.info("Restored from backup: %s", backup_path)
             return True, "Successfully restored from backup"
         except Exception as e:
-            logging.error(f"Failed to restore backup: {e}")
+            safe_unlink(temp_output)
+            logging.error("Failed to restore backup: %s", e)
             return False, str(e)
+        
+        finally:
+            self.invalidate_stat(esm_path)
+
+
+# Shown by the GUI Help button
+HELP_TEXT = """
+Fallout 4 ESM Patcher - Help
+
+PURPOSE:
+This tool patches Fallout4.esm files between different versions:
+• Next-Gen → 1.10.163
+• 1.10.163 → Next-Gen
+• VR → 1.10.163 / Next-Gen
+
+HOW TO USE:
+1. Click "Auto-Detect" to find Fallout 4 installations
+   OR click "Browse Folder" to select your Fallout 4 folder
+
+2. The tool will analyze the file and show the detected version
+
+3. Select your target version from the "Patch Target" options
+
+4. Click "Apply Patch"
+   - A backup will be created automatically
+   - The original file will be patched
+
+5. If something goes wrong, use "Restore Backup" to revert
+
+SUPPORTED VERSIONS:
+- Next-Gen: 330,777,465 bytes
+  • Can patch to: 1.10.163
+
+- 1.10.163: 330,745,373 bytes
+  • Can patch to: Next-Gen
+
+- VR: 330,553,163 bytes
+  • Can patch to: 1.10.163, Next-Gen
+
+NOTES:
+- Always creates a backup before patching
+- Check the log file for detailed information
+- Make sure Fallout 4 is not running when patching
+
+For more information, visit the Nexus Mods page.
+"""
 
 
 class PatcherGUI:
@@ -379,6 +717,11 @@ class PatcherGUI:
         self.version_info = None  # Stores detected version info
         self.target_version = None  # Selected target version
         
+        # Patch worker state (see apply_patch / poll_patch)
+        self._patching = False
+        self.patch_stage = (0, "")
+        self.patch_result = None
+        
         # Setup main window
         self.root = tk.Tk()
         self.root.title("Fallout 4 ESM Patcher v1.1")
@@ -395,6 +738,9 @@ class PatcherGUI:
         
         self.setup_ui()
         
+        # Don't allow closing the window while xdelta3 is running
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        
         # Verify dependencies on startup
         deps_ok, deps_msg = self.patcher.verify_dependencies()
         if not deps_ok:
@@ -438,20 +784,22 @@ class PatcherGUI:
         self.file_entry = tk.Entry(file_frame, font=("Arial", 10))
         self.file_entry.pack(side="left", fill="x", expand=True)
         
-        tk.Button(
+        self.browse_button = tk.Button(
             file_frame,
             text="Browse Folder",
             command=self.browse_folder,
             width=12
-        ).pack(side="right", padx=(5, 0))
+        )
+        self.browse_button.pack(side="right", padx=(5, 0))
         
         # Auto-detect button
-        tk.Button(
+        self.detect_button = tk.Button(
             main_frame,
             text="Auto-Detect Fallout 4 Installations",
             command=self.auto_detect,
             width=30
-        ).pack(pady=5)
+        )
+        self.detect_button.pack(pady=5)
         
         # Status display with adjusted height
         tk.Label(main_frame, text="File Status:", font=("Arial", 12)).pack(anchor="w", pady=(10, 5))  # Reduced top padding
@@ -462,7 +810,8 @@ class PatcherGUI:
             font=("Courier", 9),
             bg="#f8f9fa",
             relief="groove",
-            borderwidth=2
+            borderwidth=2,
+            state="disabled"  # Read-only; written through write_status
         )
         self.status_text.pack(fill="both", expand=True)
         
@@ -548,24 +897,10 @@ class PatcherGUI:
         )
         
         if folder_path:
-            # Look for Fallout4.esm in different possible locations
-            esm_found = False
-            esm_path = None
-            
-            # Check patterns: root folder, Data subfolder
-            search_locations = [
-                os.path.join(folder_path, "Fallout4.esm"),
-                os.path.join(folder_path, "Data", "Fallout4.esm"),
-                os.path.join(folder_path, "data", "Fallout4.esm"),  # Case variation
-            ]
-            
-            for location in search_locations:
-                if os.path.exists(location):
-                    esm_path = location
-                    esm_found = True
-                    break
+            # Look for Fallout4.esm in the root folder or Data subfolder
+            esm_path = find_esm_in_folder(folder_path)
             
-            if esm_found:
+            if esm_path:
                 self.file_entry.delete(0, tk.END)
                 self.file_entry.insert(0, esm_path)
                 self.analyze_file(esm_path)
@@ -591,8 +926,7 @@ class PatcherGUI:
     
     def auto_detect(self):
         """Auto-detect Fallout 4 installations"""
-        self.status_text.delete(1.0, tk.END)
-        self.status_text.insert(tk.END, "Searching for Fallout 4 installations...\n\n")
+        self.write_status("Searching for Fallout 4 installations...\n\n", clear=True)
         self.root.update()
         
         search_paths = [
@@ -608,35 +942,48 @@ class PatcherGUI:
             r"C:\Program Files (x86)\GOG Galaxy\Games\Fallout 4",
         ]
         
-        found_files = []
+        # Check both root and Data subfolder
+        candidates = [
+            os.path.join(base_path, sub_path, "Fallout4.esm")
+            for base_path in search_paths
+            for sub_path in ["", "Data"]
+        ]
         
-        for base_path in search_paths:
-            # Check both root and Data subfolder
-            for sub_path in ["", "Data"]:
-                full_path = os.path.join(base_path, sub_path) if sub_path else base_path
-                esm_path = os.path.join(full_path, "Fallout4.esm")
-                
-                if os.path.exists(esm_path):
-                    found_files.append(esm_path)
-                    self.status_text.insert(tk.END, f"Found: {esm_path}\n")
+        # Probe all locations concurrently so slow or spun-down drives don't stall each other
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            exists = list(executor.map(os.path.exists, candidates))
+        
+        found_files = [esm_path for esm_path, found in zip(candidates, exists) if found]
+        
+        # Build the report and insert it in one call
+        parts = [f"Found: {esm_path}\n" for esm_path in found_files]
         
         if found_files:
-            self.status_text.insert(tk.END, f"\nFound {len(found_files)} installation(s)\n")
-            if len(found_files) == 1:
-                self.file_entry.delete(0, tk.END)
-                self.file_entry.insert(0, found_files[0])
-                self.analyze_file(found_files[0])
-            else:
-                self.status_text.insert(tk.END, "\nMultiple installations found. Analyzing first one...")
-                self.file_entry.delete(0, tk.END)
-                self.file_entry.insert(0, found_files[0])
-                self.analyze_file(found_files[0])
+            parts.append(f"\nFound {len(found_files)} installation(s)\n")
+            if len(found_files) > 1:
+                parts.append("\nMultiple installations found. Analyzing first one...")
+            self.write_status("".join(parts))
+            
+            self.file_entry.delete(0, tk.END)
+            self.file_entry.insert(0, found_files[0])
+            self.analyze_file(found_files[0])
         else:
-            self.status_text.insert(tk.END, "\nNo Fallout 4 installations found.\nPlease browse manually using 'Browse Folder'.")
+            parts.append("\nNo Fallout 4 installations found.\nPlease browse manually using 'Browse Folder'.")
+            self.write_status("".join(parts))
+    
+    def write_status(self, text: str, clear: bool = False):
+        """Write text to the status box with a single insert"""
+        self.status_text.configure(state="normal")
+        if clear:
+            self.status_text.delete(1.0, tk.END)
+        self.status_text.insert(tk.END, text)
+        self.status_text.configure(state="disabled")
     
     def analyze_file(self, file_path: str):
         """Analyze the selected ESM file"""
-        self.status_text.delete(1.0, tk.END)
+        if self._patching:
+            return
+        
         self.selected_file = file_path
         self.version_info = None
         self.patch_info = None
@@ -648,42 +995,46 @@ class PatcherGUI:
         file_info = self.patcher.get_file_info(file_path)
         
         if not file_info["exists"]:
-            self.status_text.insert(tk.END, "ERROR: File does not exist!")
+            self.write_status("ERROR: File does not exist!", clear=True)
             self.patch_button.config(state="disabled")
             return
         
-        # Display file info
-        self.status_text.insert(tk.END, f"File: {os.path.basename(file_path)}\n")
-        self.status_text.insert(tk.END, f"Path: {os.path.dirname(file_path)}\n")
-        self.status_text.insert(tk.END, f"Size: {file_info['size']:,} bytes ({file_info['size_mb']:.2f} MB)\n\n")
+        # Collect the status report and insert it in one call
+        parts = [
+            f"File: {os.path.basename(file_path)}\n",
+            f"Path: {os.path.dirname(file_path)}\n",
+            f"Size: {file_info['size']:,} bytes ({file_info['size_mb']:.2f} MB)\n\n",
+        ]
         
         # Detect version using new method
         self.version_info = self.patcher.detect_esm_version(file_path)
         
-        self.status_text.insert(tk.END, f"Detected: {self.version_info['display']}\n")
+        parts.append(f"Detected: {self.version_info['display']}\n")
         
         if self.version_info["available_targets"]:
-            self.status_text.insert(tk.END, f"\n✓ This file can be patched\n")
-            self.status_text.insert(tk.END, f"Available targets: {', '.join(self.version_info['available_targets'])}\n")
+            parts.append("\n✓ This file can be patched\n")
+            parts.append(f"Available targets: {', '.join(self.version_info['available_targets'])}\n")
             
             # Populate target selection options
             self.populate_target_options(self.version_info["available_targets"])
         else:
             self.patch_button.config(state="disabled")
             if self.version_info["version"] == "patched":
-                self.status_text.insert(tk.END, "\n✓ This file is already patched/compatible!\n")
+                parts.append("\n✓ This file is already patched/compatible!\n")
             elif self.version_info["version"] is None:
-                self.status_text.insert(tk.END, "\n⚠ Unknown file version - cannot patch\n")
+                parts.append("\n⚠ Unknown file version - cannot patch\n")
             else:
-                self.status_text.insert(tk.END, "\n⚠ No patches available for this version\n")
+                parts.append("\n⚠ No patches available for this version\n")
         
         # Check for backup
         backup_path = file_path + ".backup"
-        if os.path.exists(backup_path):
-            self.status_text.insert(tk.END, f"\n📁 Backup found: {os.path.basename(backup_path)}")
+        if self.patcher.cached_stat(backup_path) is not None:
+            parts.append(f"\n📁 Backup found: {os.path.basename(backup_path)}")
             self.restore_button.config(state="normal")
         else:
             self.restore_button.config(state="disabled")
+        
+        self.write_status("".join(parts), clear=True)
     
     def clear_target_options(self):
         """Clear the target version selection options"""
@@ -725,9 +1076,12 @@ class PatcherGUI:
     
     def on_target_selected(self):
         """Handle target version selection"""
+        if self._patching:
+            return
+        
         target = self.target_var.get()
         if target and target != "none" and self.selected_file:
-            self.patch_info = self.patcher.get_patch_for_target(self.selected_file, target)
+            self.patch_info = self.patcher.get_patch_for_target(self.selected_file, target, self.version_info)
             if self.patch_info:
                 self.patch_button.config(state="normal")
             else:
@@ -737,11 +1091,12 @@ class PatcherGUI:
         """Update progress bar and label"""
         self.progress_var.set(value)
         self.progress_label.config(text=text)
-        self.root.update()
+        # Redraw only; don't re-enter the event loop
+        self.root.update_idletasks()
     
     def apply_patch(self):
         """Apply the patch to the selected file"""
-        if not self.selected_file or not self.patch_info:
+        if self._patching or not self.selected_file or not self.patch_info:
             return
         
         target = self.target_var.get()
@@ -757,32 +1112,86 @@ class PatcherGUI:
         if not result:
             return
         
-        # Disable buttons during patching
-        self.patch_button.config(state="disabled")
-        self.restore_button.config(state="disabled")
+        esm_path = self.selected_file
+        patch_info = self.patch_info
+        
+        # Ask about an existing backup here; the worker thread can't show dialogs
+        if not self.patcher.confirm_backup_overwrite(esm_path):
+            messagebox.showerror("Backup Failed", "Failed to create backup:\nBackup cancelled by user")
+            return
+        
+        # Lock the UI until the patch has finished
+        self._patching = True
+        self.set_controls_enabled(False)
+        
+        # Back up and run xdelta3 on a worker thread, polled from the Tk main loop
+        self.patch_stage = (10, "Creating backup...")
+        self.patch_result = None
+        self.update_progress(*self.patch_stage)
+        worker = threading.Thread(
+            target=self.run_patch_worker,
+            args=(esm_path, patch_info)
+        )
+        worker.start()
         
+        expected_size = self.patcher.get_version_size(patch_info.get("target_version"))
+        self.root.after(100, self.poll_patch, worker, esm_path, expected_size)
+    
+    def run_patch_worker(self, esm_path: str, patch_info: dict):
+        """Back up and patch the file (runs on a worker thread, must not touch Tk widgets)"""
         try:
-            # Create backup
-            self.update_progress(10, "Creating backup...")
-            success, backup_msg = self.patcher.create_backup(self.selected_file)
-            
+            # A copy fallback (no hard links, e.g. FAT/exFAT) can take a while
+            success, backup_msg = self.patcher.create_backup(esm_path, confirm_overwrite=False)
             if not success:
-                messagebox.showerror("Backup Failed", f"Failed to create backup:\n{backup_msg}")
+                self.patch_result = (False, backup_msg, False)
                 return
             
-            # Apply patch
-            success, patch_msg = self.patcher.apply_patch(
-                self.selected_file,
-                self.patch_info,
-                self.update_progress
-            )
+            self.patch_result = self.patcher.apply_patch(esm_path, patch_info, self.record_patch_stage)
+        except Exception as e:
+            logging.error("Patch worker failed: %s", e)
+            self.patch_result = (False, str(e))
+    
+    def record_patch_stage(self, value: int, text: str):
+        """Progress callback for the worker thread; picked up by poll_patch"""
+        self.patch_stage = (value, text)
+    
+    def poll_patch(self, worker: threading.Thread, esm_path: str, expected_size: Optional[int]):
+        """Update progress while the patch worker runs"""
+        if not worker.is_alive():
+            # No result means the worker died before it could report one
+            result = self.patch_result or (False, "The patch worker stopped unexpectedly")
+            self.on_patch_done(esm_path, *result)
+            return
+        
+        value, text = self.patch_stage
+        
+        # While xdelta3 runs, estimate progress from the output file size
+        if value == 30 and expected_size:
+            try:
+                written = os.path.getsize(self.patcher.get_patched_output_path(esm_path))
+                value += int(40 * min(written / expected_size, 1.0))
+            except OSError:
+                pass
+        
+        self.update_progress(value, text)
+        self.root.after(100, self.poll_patch, worker, esm_path, expected_size)
+    
+    def on_patch_done(self, esm_path: str, success: bool, patch_msg: str, backed_up: bool = True):
+        """Report the patch result once the worker has finished (backed_up=False if the backup failed)"""
+        # The worker is done with the file, so analysis and restore are safe again
+        self._patching = False
+        
+        try:
+            if not backed_up:
+                messagebox.showerror("Backup Failed", f"Failed to create backup:\n{patch_msg}")
+                return
             
             self.update_progress(100, "Complete!")
             
             if success:
                 messagebox.showinfo("Success", patch_msg)
                 # Re-analyze the file to show new status
-                self.analyze_file(self.selected_file)
+                self.analyze_file(esm_path)
             else:
                 messagebox.showerror("Patch Failed", f"Failed to apply patch:\n{patch_msg}")
                 
@@ -796,18 +1205,45 @@ class PatcherGUI:
                         self.restore_backup()
         
         finally:
-            # Reset progress
-            self.update_progress(0, "")
-            
-            # Re-enable buttons as appropriate
-            if self.patch_info:
-                self.patch_button.config(state="normal")
-            if os.path.exists(self.selected_file + ".backup"):
-                self.restore_button.config(state="normal")
+            self.finish_patch(esm_path)
+    
+    def finish_patch(self, esm_path: str):
+        """Reset progress and re-enable buttons after patching"""
+        self._patching = False
+        
+        # Reset progress
+        self.update_progress(0, "")
+        
+        # Re-enable buttons as appropriate
+        self.set_controls_enabled(True)
+        if self.patch_info:
+            self.patch_button.config(state="normal")
+        if self.patcher.cached_stat(esm_path + ".backup") is not None:
+            self.restore_button.config(state="normal")
+    
+    def set_controls_enabled(self, enabled: bool):
+        """Enable or disable file selection and target controls (Apply/Restore are always disabled here)"""
+        state = "normal" if enabled else "disabled"
+        self.browse_button.config(state=state)
+        self.detect_button.config(state=state)
+        for rb in self.target_radio_buttons:
+            rb.config(state=state)
+        self.patch_button.config(state="disabled")
+        self.restore_button.config(state="disabled")
+    
+    def on_close(self):
+        """Handle the window close button"""
+        if self._patching:
+            messagebox.showwarning(
+                "Patch In Progress",
+                "Patching is still in progress.\n\nPlease wait for it to finish before closing."
+            )
+            return
+        self.root.destroy()
     
     def restore_backup(self):
         """Restore from backup"""
-        if not self.selected_file:
+        if self._patching or not self.selected_file:
             return
         
         result = messagebox.askyesno(
@@ -829,48 +1265,7 @@ class PatcherGUI:
     
     def show_help(self):
         """Show help dialog"""
-        help_text = """
-Fallout 4 ESM Patcher - Help
-
-PURPOSE:
-This tool patches Fallout4.esm files between different versions:
-• Next-Gen → 1.10.163
-• 1.10.163 → Next-Gen
-• VR → 1.10.163 / Next-Gen
-
-HOW TO USE:
-1. Click "Auto-Detect" to find Fallout 4 installations
-   OR click "Browse Folder" to select your Fallout 4 folder
-
-2. The tool will analyze the file and show the detected version
-
-3. Select your target version from the "Patch Target" options
-
-4. Click "Apply Patch"
-   - A backup will be created automatically
-   - The original file will be patched
-
-5. If something goes wrong, use "Restore Backup" to revert
-
-SUPPORTED VERSIONS:
-- Next-Gen: 330,777,465 bytes
-  • Can patch to: 1.10.163
-
-- 1.10.163: 330,745,373 bytes
-  • Can patch to: Next-Gen
-
-- VR: 330,553,163 bytes
-  • Can patch to: 1.10.163, Next-Gen
-
-NOTES:
-- Always creates a backup before patching
-- Check the log file for detailed information
-- Make sure Fallout 4 is not running when patching
-
-For more information, visit the Nexus Mods page.
-        """
-        
-        messagebox.showinfo("Help", help_text)
+        messagebox.showinfo("Help", HELP_TEXT)
     
     def run(self):
         """Run the GUI"""
@@ -898,43 +1293,47 @@ def main():
                 print('  esm_patcher.py "C:\\Games\\Fallout 4\\Data\\Fallout4.esm" --target nextgen')
                 sys.exit(0)
             
-            # Parse arguments
-            input_path = sys.argv[1]
-            target_version = None
-            
-            # Check for --target flag
-            if "--target" in sys.argv:
-                target_idx = sys.argv.index("--target")
-                if target_idx + 1 < len(sys.argv):
-                    target_version = sys.argv[target_idx + 1]
-                    if target_version not in ["1.10.163", "nextgen"]:
-                        print(f"Error: Invalid target version '{target_version}'")
-                        print("Valid targets: 1.10.163, nextgen")
+            # Parse arguments in a single pass
+            args = {"--target": None, "positional": []}
+            argv = iter(sys.argv[1:])
+            for arg in argv:
+                if arg == "--target":
+                    args["--target"] = next(argv, None)
+                    if args["--target"] is None:
+                        print("Error: --target requires a version argument")
                         sys.exit(1)
                 else:
-                    print("Error: --target requires a version argument")
-                    sys.exit(1)
+                    args["positional"].append(arg)
+            
+            if not args["positional"]:
+                print("Error: No path specified")
+                print("Please specify a folder or .esm file")
+                sys.exit(1)
+            
+            input_path = args["positional"][0]
+            target_version = args["--target"]
+            
+            if target_version is not None and target_version not in VALID_TARGETS:
+                print(f"Error: Invalid target version '{target_version}'")
+                print("Valid targets: 1.10.163, nextgen")
+                sys.exit(1)
             
             esm_path = None
             
-            # Check if it's a file or directory
-            if os.path.isfile(input_path) and input_path.lower().endswith('.esm'):
+            # Check if it's a file or directory (one stat for both checks)
+            try:
+                input_mode = os.stat(input_path).st_mode
+            except OSError:
+                input_mode = 0
+            
+            if stat.S_ISREG(input_mode) and input_path.lower().endswith(ESM_SUFFIX):
                 esm_path = input_path
-            elif os.path.isdir(input_path):
+            elif stat.S_ISDIR(input_mode):
                 # Search for Fallout4.esm in the directory
-                search_locations = [
-                    os.path.join(input_path, "Fallout4.esm"),
-                    os.path.join(input_path, "Data", "Fallout4.esm"),
-                    os.path.join(input_path, "data", "Fallout4.esm"),
-                ]
-                
-                for location in search_locations:
-                    if os.path.exists(location):
-                        esm_path = location
-                        print(f"Found Fallout4.esm at: {esm_path}")
-                        break
-                
-                if not esm_path:
+                esm_path = find_esm_in_folder(input_path)
+                if esm_path:
+                    print(f"Found Fallout4.esm at: {esm_path}")
+                else:
                     print(f"Error: Fallout4.esm not found in {input_path}")
                     print("Please specify the game folder or the direct path to Fallout4.esm")
                     sys.exit(1)
@@ -983,7 +1382,7 @@ def main():
                 sys.exit(1)
             
             # Get patch info
-            patch_info = patcher.get_patch_for_target(esm_path, target_version)
+            patch_info = patcher.get_patch_for_target(esm_path, target_version, version_info)
             if not patch_info:
                 print(f"Error: No patch found for target '{target_version}'")
                 sys.exit(1)
@@ -1017,7 +1416,7 @@ def main():
         print("\nCancelled by user")
         sys.exit(0)
     except Exception as e:
-        logging.error(f"Fatal error: {e}")
+        logging.error("Fatal error: %s", e)
         print(f"Fatal error: {e}")
         sys.exit(1)
 